@@ -17,8 +17,11 @@ python download_hansard_html.py
 """
 
 import collections
-from datetime import datetime, timezone, timedelta
+import concurrent.futures as cf
+import itertools
+import os
 import sqlite3
+import threading
 import time
 import urllib.parse
 import zlib
@@ -28,10 +31,38 @@ import requests
 from requests.adapters import HTTPAdapter, Retry
 
 
-def wait_a_bit(request_start, seconds_per_request=7.51):
-    taken = time.monotonic() - request_start
-    delay = max(seconds_per_request - taken, 0)
-    time.sleep(delay)
+class RateLimiter:
+    """
+    Token bucket limiting the rate of requests from any number of threads.
+
+    Up to burst requests can start immediately, after which requests start at
+    an average of one every seconds_per_request.
+
+    """
+
+    def __init__(self, seconds_per_request=7.51, burst=1):
+        self.seconds_per_request = seconds_per_request
+        self.burst = burst
+        self.tokens = burst
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait_a_bit(self):
+        # Take a token under the lock, going into debt if none are left, but
+        # sleep outside it so other threads can queue up behind this one.
+        with self.lock:
+            now = time.monotonic()
+
+            if self.seconds_per_request:
+                refill = (now - self.last_refill) / self.seconds_per_request
+            else:
+                refill = self.burst
+
+            self.tokens = min(self.burst, self.tokens + refill) - 1
+            self.last_refill = now
+            delay = max(-self.tokens, 0) * self.seconds_per_request
+
+        time.sleep(delay)
 
 
 session = requests.Session()
@@ -39,12 +70,18 @@ retries = Retry(
     total=10,
     backoff_factor=1,
     backoff_max=300,
-    status_forcelist=[500, 502, 503, 504],
+    # Retry-After is respected for these, including when rate limited.
+    status_forcelist=[429, 500, 502, 503, 504],
     backoff_jitter=20,
 )
 
-session.mount("http://", HTTPAdapter(max_retries=retries))
-session.mount("https://", HTTPAdapter(max_retries=retries))
+# Keep enough pooled connections for every download thread, so each request
+# reuses an open keep-alive connection instead of a fresh TCP/TLS handshake.
+adapter = HTTPAdapter(
+    max_retries=retries, pool_connections=16, pool_maxsize=16, pool_block=True
+)
+session.mount("http://", adapter)
+session.mount("https://", adapter)
 
 session.headers.update(
     {
@@ -53,36 +90,140 @@ session.headers.update(
 )
 
 
-def get_sitemap_urls(sitemap_loc):
+def iterparse_sitemap(sitemap_loc, tag):
+    """
+    Yield (loc, lastmod) for each tag element of a sitemap.
+
+    The response is parsed incrementally, and each element is discarded
+    after use so memory use doesn't grow with the size of the sitemap.
+
+    """
     sitemap_ns = "{http://www.sitemaps.org/schemas/sitemap/0.9}"
-    request = session.get(sitemap_loc)
-    sitemap_map = etree.fromstring(request.content)
 
-    return [
-        (elem.find(sitemap_ns + "loc").text, elem.find(sitemap_ns + "lastmod").text)
-        for elem in sitemap_map.findall(sitemap_ns + "sitemap")
-    ]
+    with session.get(sitemap_loc, stream=True) as response:
+        response.raw.decode_content = True
+
+        for _, elem in etree.iterparse(
+            response.raw, events=("end",), tag=sitemap_ns + tag
+        ):
+            yield (
+                elem.find(sitemap_ns + "loc").text,
+                elem.find(sitemap_ns + "lastmod").text,
+            )
+
+            elem.clear(keep_tail=False)
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+
+
+def get_sitemap_urls(sitemap_loc):
+    return list(iterparse_sitemap(sitemap_loc, "sitemap"))
 
 
 def get_location_urls(sitemap_url):
-    sitemap_ns = "{http://www.sitemaps.org/schemas/sitemap/0.9}"
-    request = session.get(sitemap_url)
-    sitemap_map = etree.fromstring(request.content)
+    return iterparse_sitemap(sitemap_url, "url")
 
-    return [
-        (elem.find(sitemap_ns + "loc").text, elem.find(sitemap_ns + "lastmod").text)
-        for elem in sitemap_map.findall(sitemap_ns + "url")
+
+def get_hansard_urls(sitemap_url, rate_limiter):
+    """Return the sitemap and the (loc, lastmod, sitemap) of its hansard urls."""
+    rate_limiter.wait_a_bit()
+
+    return sitemap_url, [
+        (loc, lastmod, sitemap_url)
+        for loc, lastmod in get_location_urls(sitemap_url)
+        if "hansard" in loc
     ]
 
 
-def download_all_html(db_path="hansard_html.db", html_zip_path="hansard_html.zip"):
+def download_page(page_id, url, rate_limiter, max_page_bytes=64 * 1024 * 1024):
+    """Download and compress a single page, returning None on failure."""
+    rate_limiter.wait_a_bit()
+
+    # The default level is much faster than level 9 for only a marginally
+    # larger page, and keeps the format readable by tidy_html_hansard.py.
+    compressor = zlib.compressobj(level=zlib.Z_DEFAULT_COMPRESSION)
+    compressed_chunks = []
+    page_bytes = 0
+
+    # We retry up to 10 ten times, but if there's a failure ultimately
+    # we just move on - the loop will repeat if necessary to retry
+    # failed pages.
+    try:
+        # The body is compressed as it arrives, so the whole uncompressed
+        # page is never held in memory.
+        with session.get(url, timeout=10, stream=True) as response:
+            response.raise_for_status()
+
+            content_length = int(response.headers.get("Content-Length", 0))
+            if content_length > max_page_bytes:
+                raise ValueError(f"Content-Length {content_length} is too large")
+
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                page_bytes += len(chunk)
+                if page_bytes > max_page_bytes:
+                    raise ValueError(f"Page is larger than {max_page_bytes} bytes")
+
+                compressed_chunks.append(compressor.compress(chunk))
+
+    except Exception as e:
+        print(f"Skipping {url} due to error: {e}")
+        return page_id, url, None
+
+    compressed_chunks.append(compressor.flush())
+
+    return page_id, url, b"".join(compressed_chunks)
+
+
+def flush_page_updates(db, batch):
+    """Write a batch of downloaded pages in a single transaction."""
+    if not batch:
+        return
+
+    db.execute("begin immediate")
+    db.executemany(
+        """
+        update proceedings_page set
+            -- Same format as the python datetimes previously stored here, so
+            -- existing access_time values still compare correctly.
+            access_time = strftime('%Y-%m-%d %H:%M:%f+00:00', 'now'),
+            compressed_page = ?
+        where page_id = ?
+        """,
+        batch,
+    )
+    db.execute("commit")
+    batch.clear()
+
+
+def download_all_html(
+    db_path="hansard_html.db",
+    html_zip_path="hansard_html.zip",
+    batch_size=50,
+    max_workers=4,
+    max_pending=16,
+    seconds_per_request=7.51,
+    request_burst=1,
+    seconds_per_sitemap=1.0,
+    sitemap_refresh_days=1,
+):
     db = sqlite3.connect(db_path, isolation_level=None)
 
+    # See the README for the durability tradeoff.
+    synchronous = os.environ.get("HANSARD_SQLITE_SYNCHRONOUS", "NORMAL").upper()
+    if synchronous not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+        raise ValueError(f"Unknown synchronous setting: {synchronous}")
+    db.execute(f"pragma synchronous={synchronous}")
+
     db.executescript(
         """
         -- This part of the process shouldn't affect already processed data.
         pragma foreign_keys=0;
         pragma journal_mode=WAL;
+        pragma temp_store=MEMORY;
+        -- 64MiB page cache and 256MiB of memory mapped IO.
+        pragma cache_size=-65536;
+        pragma mmap_size=268435456;
+        pragma busy_timeout=5000;
 
         create table if not exists proceedings_page (
             /*
@@ -99,15 +240,40 @@ def download_all_html(db_path="hansard_html.db", html_zip_path="hansard_html.zip
             -- The time the transcript was retrieved, null if not yet retrieved.
             access_time,
             -- The downloaded HTML of this page, compressed with zlib.
-            compressed_page
+            compressed_page,
+            -- The sitemap this page was last listed in.
+            sitemap
         );
 
         create index if not exists proceedings_access on proceedings_page(access_time);
 
+        -- Partial index matching the to_download query below exactly, so
+        -- finding outstanding pages doesn't need a full scan and sort.
+        create index if not exists proceedings_to_download on proceedings_page(
+            coalesce(access_time, '1900-01-01')
+        )
+        where access_time is null or access_time < last_mod;
+
+        -- The lastmod of each sitemap as of the last time it was processed,
+        -- so unchanged sitemaps don't need to be fetched again.
+        create table if not exists sitemap (
+            url primary key,
+            last_mod not null
+        );
+
         -- Used for finding updated HTML fragments.
         create temporary table active_proceedings(
             url primary key,
-            last_mod not null
+            last_mod not null,
+            sitemap not null
+        );
+
+        -- All sitemaps in the current sitemap index, and whether they were
+        -- refetched on this run.
+        create temporary table current_sitemap(
+            url primary key,
+            last_mod not null,
+            refreshed bool not null
         );
 
         create table if not exists metadata (
@@ -120,41 +286,103 @@ def download_all_html(db_path="hansard_html.db", html_zip_path="hansard_html.zip
         """
     )
 
+    # Databases created before the sitemap cache need the extra column.
+    columns = {row[1] for row in db.execute("pragma table_info(proceedings_page)")}
+    if "sitemap" not in columns:
+        db.execute("alter table proceedings_page add column sitemap")
+        db.execute("delete from sitemap")
+
     # Periodically update the list of pages using the sitemap, but only
-    # if not done within the last 24 hours.
-    time_since_last_sitemap_check = list(
+    # if not done within the last sitemap_refresh_days.
+    sitemap_check_due = list(
         db.execute(
-            "select julianday('now') - value from metadata where key = 'last-run'"
+            """
+            select julianday('now') - value > ?
+            from metadata
+            where key = 'last-run'
+            """,
+            [sitemap_refresh_days],
         )
     )[0][0]
 
-    if time_since_last_sitemap_check > 1:
+    if sitemap_check_due:
         all_sitemaps = get_sitemap_urls(
             "https://parlinfo.aph.gov.au/sitemap/sitemapindex.xml"
         )
 
+        cached_sitemaps = dict(db.execute("select url, last_mod from sitemap"))
+
         print("Checking sitemaps for updated fragments.")
         db.execute("begin")
 
-        # Note that we check all sitemaps, because otherwise we can't tell
-        # if urls have been deleted from the global list.
-        for i, (sitemap, _) in enumerate(all_sitemaps):
-            print(f"{sitemap} - {i+1} / up to {len(all_sitemaps)}")
-
-            # Process all subsites, so we can confirm if a fragment is deleted.
-            subsite_urls = get_location_urls(sitemap)
-            hansard_urls = [
-                (loc, lastmod) for loc, lastmod in subsite_urls if "hansard" in loc
-            ]
-
-            # Mark updated hansard URLs
-            db.executemany("insert into active_proceedings values (?, ?)", hansard_urls)
+        db.executemany(
+            "insert into current_sitemap values (?, ?, ?)",
+            (
+                (
+                    sitemap,
+                    lastmod,
+                    sitemap not in cached_sitemaps
+                    or lastmod > cached_sitemaps[sitemap],
+                )
+                for sitemap, lastmod in all_sitemaps
+            ),
+        )
 
-        # 1. Handle deleted pages
+        # Only sitemaps modified since they were last processed are fetched.
+        # Pages from unchanged sitemaps are known to still be listed, so we
+        # can still tell if urls have been deleted from the global list.
+        refreshed_sitemaps = [
+            row[0]
+            for row in db.execute("select url from current_sitemap where refreshed")
+        ]
+
+        # Sitemaps are small and few compared to the pages, so they have their
+        # own, looser, limit rather than waiting behind the page downloads.
+        sitemap_limiter = RateLimiter(seconds_per_sitemap)
+
+        # Sitemaps are fetched and parsed on worker threads, but only the
+        # main thread writes to the database. Each sitemap's urls are dropped
+        # once inserted, and only a bounded number of sitemaps are in flight.
+        pending = collections.deque()
+        to_submit = iter(refreshed_sitemaps)
+        pool = cf.ThreadPoolExecutor(max_workers=max_workers)
+
+        try:
+            for i in range(len(refreshed_sitemaps)):
+                for sitemap in itertools.islice(to_submit, max_pending - len(pending)):
+                    pending.append(
+                        pool.submit(get_hansard_urls, sitemap, sitemap_limiter)
+                    )
+
+                sitemap, hansard_urls = pending.popleft().result()
+                print(f"{sitemap} - {i+1} / up to {len(refreshed_sitemaps)}")
+
+                # Mark updated hansard URLs
+                db.executemany(
+                    "insert into active_proceedings values (?, ?, ?)", hansard_urls
+                )
+
+        finally:
+            pool.shutdown(cancel_futures=True)
+
+        # 1. Handle deleted pages - anything not listed in a refreshed sitemap,
+        # unless it belongs to an unchanged sitemap. Pages without a sitemap
+        # predate the sitemap cache: on that first run every sitemap is
+        # refreshed so this is the same as checking everything.
         db.execute(
             """
             delete from proceedings_page
-            where url not in (select url from active_proceedings)
+            where not exists (
+                    select 1
+                    from active_proceedings ap
+                    where ap.url = proceedings_page.url
+                )
+                and not exists (
+                    select 1
+                    from current_sitemap cs
+                    where cs.url = proceedings_page.sitemap
+                        and not cs.refreshed
+                )
             """
         )
 
@@ -162,13 +390,16 @@ def download_all_html(db_path="hansard_html.db", html_zip_path="hansard_html.zip
         # downloaded version available.
         db.execute(
             """
-            replace into proceedings_page(page_id, url, last_mod, access_time, compressed_page)
+            replace into proceedings_page(
+                page_id, url, last_mod, access_time, compressed_page, sitemap
+            )
             select
                 pp.page_id,
                 ap.url,
                 ap.last_mod,
                 pp.access_time,
-                pp.compressed_page
+                pp.compressed_page,
+                ap.sitemap
             from active_proceedings ap
             left outer join proceedings_page pp using(url)
             where pp.last_mod is null
@@ -176,7 +407,28 @@ def download_all_html(db_path="hansard_html.db", html_zip_path="hansard_html.zip
             """
         )
 
-        db.execute("replace into metadata values('last-run', julianday('now'))")
+        # 3. Track which sitemap unchanged pages are now listed in.
+        db.execute(
+            """
+            update proceedings_page set
+                sitemap = (
+                    select sitemap
+                    from active_proceedings ap
+                    where ap.url = proceedings_page.url
+                )
+            where url in (select url from active_proceedings)
+            """
+        )
+
+        db.execute("delete from sitemap")
+        db.execute("insert into sitemap select url, last_mod from current_sitemap")
+
+        db.execute(
+            """
+            insert into metadata(key, value) values('last-run', julianday('now'))
+            on conflict(key) do update set value = excluded.value
+            """
+        )
         db.execute("commit")
 
     while True:
@@ -205,39 +457,47 @@ def download_all_html(db_path="hansard_html.db", html_zip_path="hansard_html.zip
 
         # Note: one errors we just move on, but the while loop won't exit until
         # all pages are successfully retrieved.
-        last_start = 0
-        tries = 0
-
-        for i, (page_id, url, last_mod) in enumerate(to_download):
-            print(f"Downloading {url}, {i+1}/{len(to_download)}")
-
-            wait_a_bit(last_start)
-
-            last_start = time.monotonic()
-
-            # We retry up to 10 ten times, but if there's a failure ultimately
-            # we just move on - the loop will repeat if necessary to retry
-            # failed pages.
-            try:
-                response = session.get(url, timeout=10)
-                response.raise_for_status()
-            except Exception as e:
-                print(f"Skipping {url} due to error: {e}")
-                continue
-
-            compressed_page = zlib.compress(response.content, level=9)
-
-            db.execute(
-                """
-                update proceedings_page set
-                    access_time = ?,
-                    compressed_page = ?
-                where url = ?
-                """,
-                [datetime.now(tz=timezone.utc), compressed_page, url],
-            )
-
-            tries = 0
+        rate_limiter = RateLimiter(seconds_per_request, request_burst)
+
+        # Downloaded pages are buffered and written in batches, so we only pay
+        # for one commit per batch instead of one per page.
+        batch = []
+
+        # Requests are made from a pool of threads so slow responses overlap,
+        # but all writes to the database happen here on the main thread. Only
+        # a bounded number of pages are in flight, so downloaded pages don't
+        # pile up in memory waiting to be written.
+        pending = collections.deque()
+        to_submit = iter(to_download)
+        pool = cf.ThreadPoolExecutor(max_workers=max_workers)
+
+        # Whatever was downloaded is still written if the loop is interrupted,
+        # and queued downloads are cancelled rather than run to completion.
+        try:
+            for i in range(len(to_download)):
+                # Top up the pending downloads before waiting on the oldest.
+                for page_id, url, _ in itertools.islice(
+                    to_submit, max_pending - len(pending)
+                ):
+                    pending.append(
+                        pool.submit(download_page, page_id, url, rate_limiter)
+                    )
+
+                page_id, url, compressed_page = pending.popleft().result()
+
+                if compressed_page is None:
+                    continue
+
+                print(f"Downloaded {url}, {i+1}/{len(to_download)}")
+
+                batch.append([compressed_page, page_id])
+
+                if len(batch) >= batch_size:
+                    flush_page_updates(db, batch)
+
+        finally:
+            pool.shutdown(cancel_futures=True)
+            flush_page_updates(db, batch)
 
     db.close()
 
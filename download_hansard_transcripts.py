@@ -7,12 +7,17 @@ Hansard transcript files.
 
 Needed dependencies:
 
-pip install --upgrade lxml requests site-map-parser
+pip install --upgrade requests site-map-parser
 
 Usage:
 
 python download_hansard_transcripts.py
 
+The transcripts are stored compressed in the database. To export the current
+version of every transcript to a zipfile:
+
+python download_hansard_transcripts.py export
+
 This is inspired by Tim Sherratt's Glam Workbench materials on Hansard [1].
 
 [1] Sherratt, Tim. (2019). GLAM-Workbench/australian-commonwealth-hansard
@@ -22,40 +27,178 @@ This is inspired by Tim Sherratt's Glam Workbench materials on Hansard [1].
 
 import collections
 from datetime import datetime, timezone, timedelta
+import html
+import os
+import re
 import sqlite3
 import time
 import urllib.parse
 import zipfile
+import zlib
 
-from lxml import html
 import requests
 from requests.adapters import HTTPAdapter, Retry
 from sitemapparser import SiteMapParser
 
 
+# The link from a transcript's HTML page to the XML version of the transcript.
+# This is the only thing needed from the page, so we search for it directly
+# rather than parsing the whole document. Only anchors are considered, as with
+# the //a/@href lookup this replaced, and the path itself is case sensitive.
+xml_transcript_href = re.compile(
+    rb"""<a\b[^>]*?\bhref\s*=\s*["']([^"']*(?-i:/toc_unixml/)[^"']*)["']""",
+    re.IGNORECASE,
+)
+
 session = requests.Session()
 retries = Retry(total=5, backoff_factor=1)
-session.mount("http://", HTTPAdapter(max_retries=retries))
+adapter = HTTPAdapter(max_retries=retries, pool_connections=16, pool_maxsize=16)
+session.mount("http://", adapter)
+session.mount("https://", adapter)
 
 
-def download_all_transcripts(
+def migrate_transcript_zip(db, transcript_zip_path):
+    """
+    Move transcripts from the zipfile used by earlier versions into the db.
+
+    This only happens once, when the compressed_xml column is first added.
+
+    """
+    columns = {row[1] for row in db.execute("pragma table_info(transcript)")}
+
+    if "compressed_xml" in columns:
+        return
+
+    db.execute("begin")
+    db.execute("alter table transcript add column compressed_xml")
+
+    if os.path.exists(transcript_zip_path):
+        print(f"Migrating transcripts from {transcript_zip_path}.")
+        downloaded = list(
+            db.execute(
+                """
+                select transcript_id, last_mod
+                from transcript
+                where xml_url is not null
+                    and access_time is not null
+                """
+            )
+        )
+
+        with zipfile.ZipFile(transcript_zip_path, "r") as transcript_zip:
+            zipped = set(transcript_zip.namelist())
+
+            for transcript_id, last_mod in downloaded:
+                path = f"{transcript_id}/{last_mod}"
+                if path in zipped:
+                    compressed_xml = zlib.compress(transcript_zip.read(path))
+                else:
+                    # Mark it for download again.
+                    compressed_xml = None
+
+                db.execute(
+                    """
+                    update transcript set
+                        compressed_xml = ?1,
+                        access_time = case when ?1 is null then null else access_time end
+                    where transcript_id = ?2
+                    """,
+                    [compressed_xml, transcript_id],
+                )
+
+    else:
+        # Without the zipfile we need to download everything again.
+        db.execute("update transcript set access_time = null where xml_url is not null")
+
+    db.execute("commit")
+
+
+def export_transcript_zip(
     db_path="hansard.db", transcript_zip_path="hansard_transcripts.zip"
 ):
+    """Write the current version of every XML transcript to a new zipfile."""
     db = sqlite3.connect(db_path, isolation_level=None)
 
+    transcript_ids = [
+        row[0]
+        for row in db.execute(
+            """
+            select transcript_id
+            from transcript
+            where compressed_xml is not null
+            order by transcript_id
+            """
+        )
+    ]
+
+    # Written sequentially in one pass, rather than appending to an existing
+    # archive.
+    with zipfile.ZipFile(
+        transcript_zip_path, "w", zipfile.ZIP_DEFLATED
+    ) as transcript_zip:
+        for transcript_id in transcript_ids:
+            last_mod, compressed_xml = list(
+                db.execute(
+                    """
+                    select last_mod, compressed_xml
+                    from transcript
+                    where transcript_id = ?
+                    """,
+                    [transcript_id],
+                )
+            )[0]
+            transcript_zip.writestr(
+                f"{transcript_id}/{last_mod}", zlib.decompress(compressed_xml)
+            )
+
+    db.close()
+
+
+def flush_transcript_updates(db, batch):
+    """Write a batch of downloaded transcripts in a single transaction."""
+    if not batch:
+        return
+
+    db.execute("begin immediate")
+    db.executemany(
+        """
+        update transcript set
+        xml_url = ?,
+        access_time = ?,
+        compressed_xml = ?
+        where transcript_id = ?
+        """,
+        batch,
+    )
+    db.execute("commit")
+    batch.clear()
+
+
+def download_all_transcripts(
+    db_path="hansard.db", transcript_zip_path="hansard_transcripts.zip", batch_size=20
+):
+    db = sqlite3.connect(db_path, isolation_level=None)
+
+    # See the README for the durability tradeoff.
+    synchronous = os.environ.get("HANSARD_SQLITE_SYNCHRONOUS", "NORMAL").upper()
+    if synchronous not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+        raise ValueError(f"Unknown synchronous setting: {synchronous}")
+    db.execute(f"pragma synchronous={synchronous}")
+
     db.executescript(
         """
         -- This part of the process shouldn't affect already processed data.
         pragma foreign_keys=0;
+        pragma journal_mode=WAL;
+        pragma temp_store=MEMORY;
+        pragma cache_size=-65536;
+        pragma mmap_size=268435456;
+        pragma busy_timeout=5000;
 
         create table if not exists transcript (
             /*
             This table acts as the driver for what work needs to be done to keep
-            the collection fresh, and also acts as the index into the zipfile of
-            raw transcripts.
-
-            The transcript_id is also the path into the zipfile for this
-            transcript.
+            the collection fresh, and also stores the raw transcripts.
 
             */
             transcript_id primary key,
@@ -67,7 +210,10 @@ def download_all_transcripts(
             access_time,
             -- The time the transcript was processed into the tidy schema.
             -- Null indicates that the work is still outstanding.
-            process_time
+            process_time,
+            -- The downloaded XML transcript, compressed with zlib. Null if
+            -- not yet retrieved or there is no XML transcript.
+            compressed_xml
         );
 
         create table if not exists metadata (
@@ -80,6 +226,8 @@ def download_all_transcripts(
         """
     )
 
+    migrate_transcript_zip(db, transcript_zip_path)
+
     # We overshoot by quite a bit, just to make sure we don't have to worry
     # about boundary effects.
     check_until = datetime.fromisoformat(
@@ -183,8 +331,8 @@ def download_all_transcripts(
 
     db.execute("commit")
 
-    # Note - we're back in autocommit mode, as we'll be doing infrequent single
-    # row updates to track files as they're updated.
+    # Note - we're back in autocommit mode, updates to track files as they're
+    # downloaded are committed in batches.
     to_download = list(
         db.execute(
             """
@@ -198,51 +346,58 @@ def download_all_transcripts(
         )
     )
 
-    # TODO: work out how to handle rebuilding the zip file with only the current
-    # versions of transcripts.
-    with zipfile.ZipFile(
-        transcript_zip_path, "a", zipfile.ZIP_DEFLATED
-    ) as transcript_zip:
+    # Completed transcripts are written in batches, and whatever has been
+    # downloaded is still saved if a request fails.
+    batch = []
+
+    try:
         for i, (transcript_id, lastmod, url) in enumerate(to_download):
             print(f"Downloading {transcript_id}, {i+1}/{len(to_download)}")
             response = session.get(url)
             response.raise_for_status()
-            transcript_page = html.fromstring(response.content)
-            transcript_page.make_links_absolute("https://parlinfo.aph.gov.au/")
-
             # Find the link to the XML version of the transcript for this page.
-            xml_transcript_links = [
-                url
-                for url in transcript_page.xpath("//a/@href")
-                if "/toc_unixml/" in url
-            ]
+            # The same link can appear more than once on the page.
+            xml_transcript_links = list(
+                {
+                    html.unescape(link.decode())
+                    for link in xml_transcript_href.findall(response.content)
+                }
+            )
             assert len(xml_transcript_links) <= 1
 
             if xml_transcript_links:
-                xml_url = xml_transcript_links[0]
+                # Only the one link is needed, so resolve it directly rather
+                # than rewriting every link in the page.
+                xml_url = urllib.parse.urljoin(
+                    "https://parlinfo.aph.gov.au/",
+                    xml_transcript_links[0],
+                )
                 response = session.get(xml_url)
                 response.raise_for_status()
-                transcript_zip.writestr(
-                    f"{transcript_id}/{lastmod}",
-                    response.content,
-                )
+                compressed_xml = zlib.compress(response.content)
             else:
                 xml_url = None
+                compressed_xml = None
 
-            db.execute(
-                """
-                update transcript set
-                xml_url = ?,
-                access_time = ?
-                where transcript_id = ?
-                """,
-                [xml_url, datetime.now(tz=timezone.utc), transcript_id],
+            batch.append(
+                [xml_url, datetime.now(tz=timezone.utc), compressed_xml, transcript_id]
             )
 
+            if len(batch) >= batch_size:
+                flush_transcript_updates(db, batch)
+
             time.sleep(1)
 
+    finally:
+        flush_transcript_updates(db, batch)
+
     db.close()
 
 
 if __name__ == "__main__":
-    download_all_transcripts()
+    import sys
+
+    if "export" in sys.argv[1:]:
+        export_transcript_zip()
+    else:
+        download_all_transcripts()
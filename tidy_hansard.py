@@ -1,6 +1,9 @@
 """
 Tidy and prepare the Hansard data downloaded using download_hansard_transcripts.py
 
+The raw XML transcripts are read from the database written by
+download_hansard_transcripts.py, so that needs to have been run first.
+
 Requirements:
 
 pip install --upgrade lxml
@@ -10,11 +13,15 @@ Usage:
 python tidy_hansard.py
 
 """
+import collections
+import concurrent.futures as cf
 from datetime import datetime
+import json
 import os
+import shutil
 import sqlite3
 import tempfile
-import zipfile
+import zlib
 
 from lxml import etree
 import requests
@@ -30,157 +37,369 @@ skip_transcripts = {
 }
 
 
-def extract_speeches(transcript_id, transcript_xml):
-    root = etree.fromstring(transcript_xml)
+# Speech-like elements, and the speech_type they're recorded as. Note that we
+# also treat questions and answers as speeches.
+speech_types = {
+    "question": "question",
+    "quest": "question",
+    "quesion": "question",
+    "answer": "answer",
+    "speech": "speech",
+}
+
+# The name.id elements of the people interjecting during a speech.
+interjector_ids = etree.XPath(".//interjection//talk.start//name.id")
+
+# Elements that give the debate context of the speeches they contain.
+debate_tags = ("debate", "subdebate.1", "subdebate.2", "petition", "petition.group")
+
+# Elements holding the titles of the debate elements above.
+debate_info_tags = ("debateinfo", "subdebateinfo", "petitioninfo", "petition.groupinfo")
+
+
+def find_child(elem, tag):
+    """
+    Return the first child of elem with the given tag, or None.
+
+    Like elem.find(tag), but without going through ElementPath.
+
+    """
+    return next(elem.iterchildren(tag), None)
+
+
+def subdebate_title(info):
+    """Return the title of a subdebate, or None if it doesn't have one."""
+    title = find_child(info, "title")
+
+    if title is not None:
+        return title.text or "<untitled sub-debate>"
+    # Edge case for 'hansard80/hansards80/1979-04-05', '2021-08-10 00:00:00'
+    para = find_child(info, "para")
+    if para is not None:
+        return para.text
+
+    return None
+
+
+def speaker_ids(speech):
+    """
+    Yield the name.id elements of the people speaking in a speech.
+
+    Equivalent to .//talk.start[not(parent::interjection)]//name.id, but
+    walking the tree directly is much faster than the XPath predicate.
+
+    """
+    for talk_start in speech.iter("talk.start"):
+        if talk_start.getparent().tag != "interjection":
+            yield from talk_start.iter("name.id")
+
+
+def discard(elem):
+    """Free an element that has been fully processed, and its earlier siblings."""
+    elem.clear()
+    while elem.getprevious() is not None:
+        del elem.getparent()[0]
+
+
+def iterparse_compressed(compressed_xml, chunk_size=64 * 1024, **kwargs):
+    """
+    Like etree.iterparse, but for zlib compressed XML.
+
+    The XML is decompressed a chunk at a time straight into the parser, so the
+    whole uncompressed document is never held in memory as bytes.
 
-    session = root.find("session.header")
-    house = session.find("chamber").text
+    """
+    parser = etree.XMLPullParser(**kwargs)
+    decompressor = zlib.decompressobj()
+
+    for start in range(0, len(compressed_xml), chunk_size):
+        parser.feed(decompressor.decompress(compressed_xml[start : start + chunk_size]))
+        yield from parser.read_events()
 
-    # Normalise houses
-    if house == "REPS":
-        house = "House of Reps"
-    elif house in ("SENATE", "SEN"):
-        house = "Senate"
+    parser.feed(decompressor.flush())
+    parser.close()
+    yield from parser.read_events()
 
-    date = session.find("date").text
 
-    # Special case - the date appears to be inconsistent in the file.
-    if transcript_id == "chamber/hansardr/2009-06-03":
-        date = "2009-06-03"
+def extract_speeches(transcript_id, compressed_xml):
+    date = house = None
 
-    debates = set()
+    # Rows for each distinct debate, keyed on the titles alone as the
+    # transcript, date and house are the same throughout.
+    debates = {}
     speeches = []
 
-    # Find speech elements at any level - the strategy is to find all
-    # speech-like elements, then backfill the expected structure - we need to
-    # do some grunt work to handle all of the edge cases though. Note that we
-    # also treat questions and answers as speeches.
-    speech_nodes = root.xpath("//speech|//question|//quest|//quesion|//answer")
-
-    for speech_number, speech in enumerate(speech_nodes):
-        # First work out the debate this speech is part of.
-
-        # Defaults to handle various edge cases
-        # 'chamber/hansards/2007-05-10'
-        debate_info = [
-            "<untitled debate>",
-            "",
-            "",
-        ]
-
-        parent = speech.getparent()
-
-        # Ascend the tree until we can fill in all of the details. Sometimes
-        # there can be interposing structure that obscures the debate, so we
-        # just walk up the tree until we hit the right elements.
-        skip = False
-        while parent is not None and parent.tag not in ("debate", "petition.group"):
-            # If we hit one of the other container tags in the parent, this is
-            # the wrong element to be the "speech". Note that there can be
-            # complex nesting - an answer tag might contain a speech tag from
-            # someone else.
-            if parent.tag in ("speech", "question", "answer", "quest", "quesion"):
-                skip = True
-                break
+    # The transcript is parsed as a stream, tracking the open speech-like and
+    # debate elements that enclose the current position. Each entry is a dict
+    # with the element, and the title for debate elements once it is known.
+    stack = []
+    open_speeches = 0
+    speech_number = 0
+
+    # Nothing looks elements up by xml:id, so the parser doesn't need to index
+    # them. huge_tree lifts libxml2's limits on very large text nodes.
+    for event, elem in iterparse_compressed(
+        compressed_xml,
+        events=("start", "end"),
+        tag=("session.header", *speech_types, *debate_tags, *debate_info_tags),
+        collect_ids=False,
+        huge_tree=True,
+    ):
+        tag = elem.tag
+
+        if event == "start":
+            # Speeches are numbered in document order, including the nested
+            # speeches that are skipped below.
+            if tag in speech_types:
+                stack.append({"elem": elem, "speech_number": speech_number})
+                speech_number += 1
+                open_speeches += 1
+            elif tag in debate_tags:
+                stack.append({"elem": elem})
+
+        elif tag == "session.header":
+            house = elem.find("chamber").text
+
+            # Normalise houses
+            if house == "REPS":
+                house = "House of Reps"
+            elif house in ("SENATE", "SEN"):
+                house = "Senate"
+
+            date = elem.find("date").text
+
+            # Special case - the date appears to be inconsistent in the file.
+            if transcript_id == "chamber/hansardr/2009-06-03":
+                date = "2009-06-03"
+
+        elif tag in debate_info_tags:
+            # Record the title on the debate element this describes - the
+            # speeches following it will need it after it's discarded.
+            parent = elem.getparent()
+            if not stack or stack[-1]["elem"] is not parent:
+                continue
+
+            debate = stack[-1]
+            parent_tag = parent.tag
+
+            if parent_tag == "debate" and tag == "debateinfo":
+                title = find_child(elem, "title")
+                if title is not None and title.text:
+                    debate["title"] = title.text
+
+            elif parent_tag in ("subdebate.1", "subdebate.2"):
+                # Edge case 'hansard80/hansardr80/1980-09-17', '2021-08-03 00:00:00'
+                # The subdebateinfo is used in preference to a debateinfo.
+                if tag == "subdebateinfo":
+                    debate["has_subdebateinfo"] = True
+                    debate.pop("title", None)
+                elif tag != "debateinfo" or debate.get("has_subdebateinfo"):
+                    continue
+
+                title = subdebate_title(elem)
+                if title is not None:
+                    debate["title"] = title
 
             # Note that not all petitions have speeches associated -
             # some are presented as the text of the petition without
             # a member speaking to them. This structure only catches
             # the petitions that have speeches
-            if parent.tag == "petition":
-                debate_info[1] = parent.find("petitioninfo").find("title").text
+            elif (parent_tag, tag) in (
+                ("petition", "petitioninfo"),
+                ("petition.group", "petition.groupinfo"),
+            ):
+                debate["title"] = find_child(elem, "title").text
+
+        elif tag in debate_tags:
+            stack.pop()
+
+            if not open_speeches:
+                discard(elem)
+
+        else:
+            this_speech_number = stack.pop()["speech_number"]
+            open_speeches -= 1
+
+            # Defaults to handle various edge cases
+            # 'chamber/hansards/2007-05-10'
+            debate_info = [
+                "<untitled debate>",
+                "",
+                "",
+            ]
+
+            # Walk out through the enclosing elements until we hit the
+            # debate. If we hit one of the other speech-like elements first,
+            # this is the wrong element to be the "speech". Note that there
+            # can be complex nesting - an answer tag might contain a speech
+            # tag from someone else. Outer subdebates and petitions take
+            # precedence over inner ones.
+            skip = False
+            for enclosing in reversed(stack):
+                enclosing_tag = enclosing["elem"].tag
+
+                if enclosing_tag in speech_types:
+                    skip = True
+                    break
+
+                if enclosing_tag in ("debate", "petition.group"):
+                    if "title" in enclosing:
+                        debate_info[0] = enclosing["title"]
+                    break
+
+                if enclosing_tag == "petition":
+                    debate_info[1] = enclosing.get("title")
+                elif "title" in enclosing:
+                    debate_info_level = 1 if enclosing_tag == "subdebate.1" else 2
+                    debate_info[debate_info_level] = enclosing["title"]
+
+            if not skip:
+                if None in debate_info:
+                    raise ValueError(
+                        f"Missing debate title in {transcript_id}: {debate_info}"
+                    )
 
-            if parent.tag in ("subdebate.1", "subdebate.2"):
-                debate_info_level = 1 if parent.tag == "subdebate.1" else 2
+                # Find all talkers and interjectors
+                speakers = {
+                    speaker.text.lower()
+                    for speaker in speaker_ids(elem)
+                    if speaker.text
+                }
+
+                interjectors = {
+                    speaker.text.lower().strip()
+                    for speaker in interjector_ids(elem)
+                    if speaker.text
+                }
+
+                debate_key = tuple(debate_info)
+                debate_row = debates.get(debate_key)
+                if debate_row is None:
+                    debate_row = (None, transcript_id, date, house, *debate_key)
+                    debates[debate_key] = debate_row
+
+                # Serialized as UTF-8 without a declaration, rather than the
+                # default ASCII, which spells every dash and curly quote as a
+                # character reference.
+                speech_xml = etree.tostring(
+                    elem, with_tail=False, encoding="utf-8", xml_declaration=False
+                )
 
-                # Edge case 'hansard80/hansardr80/1980-09-17', '2021-08-03 00:00:00'
-                if parent.find("subdebateinfo") is not None:
-                    subdebateinfo = parent.find("subdebateinfo")
-                elif parent.find("debateinfo") is not None:
-                    subdebateinfo = parent.find("debateinfo")
+                speeches.append(
+                    (
+                        (
+                            *debate_row,
+                            this_speech_number,
+                            speech_types[tag],
+                            speech_xml,
+                        ),
+                        speakers,
+                        interjectors,
+                    )
+                )
 
-                title = subdebateinfo.find("title")
+            # Nested speeches are still needed for the enclosing speech.
+            if not open_speeches:
+                discard(elem)
 
-                if title is not None:
-                    if title.text:
-                        debate_info[debate_info_level] = title.text
-                    else:
-                        debate_info[debate_info_level] = "<untitled sub-debate>"
-                # Edge case for 'hansard80/hansards80/1979-04-05', '2021-08-10 00:00:00'
-                elif subdebateinfo.find("para") is not None:
-                    debate_info[debate_info_level] = subdebateinfo.find("para").text
+    # Speeches are emitted as they close, so put them back in document order.
+    speeches.sort(key=lambda speech: speech[0][7])
 
-            parent = parent.getparent()
+    return list(debates.values()), speeches
 
-        if skip:
-            continue
 
-        if parent is not None and parent.tag == "debate":
-            deb_info = parent.find("debateinfo")
-            if deb_info is not None:
-                title = deb_info.find("title")
-                if title is not None and title.text:
-                    debate_info[0] = title.text
+def extract_transcript(transcript_id, compressed_xml):
+    """Extract the speeches from a transcript in a worker process."""
+    return transcript_id, *extract_speeches(transcript_id, compressed_xml)
 
-        elif parent is not None:
-            debate_info[0] = parent.find("petition.groupinfo").find("title").text
 
-        if None in debate_info:
-            breakpoint()
+def extract_transcripts(db_conn, transcript_ids, max_pending=64):
+    """
+    Yield (transcript_id, debates, speeches) for each transcript, in order.
 
-        # Find all talkers and interjectors
-        speakers = {
-            speaker.text.lower()
-            for speaker in speech.xpath(
-                ".//talk.start[not(parent::interjection)]//name.id"
-            )
-            if speaker.text
-        }
-
-        interjectors = {
-            speaker.text.lower().strip()
-            for speaker in speech.xpath(".//interjection//talk.start//name.id")
-            if speaker.text
-        }
-
-        debate_row = (None, transcript_id, date, house, *debate_info)
-        debates.add(debate_row)
-
-        speech_type = {
-            "question": "question",
-            "quest": "question",
-            "quesion": "question",
-            "answer": "answer",
-            "speech": "speech",
-        }[speech.tag]
-
-        speeches.append(
-            (
-                (
-                    *debate_row,
-                    speech_number,
-                    speech_type,
-                    etree.tostring(speech, with_tail=False),
-                ),
-                speakers,
-                interjectors,
+    The extraction is spread across a pool of processes, while the results
+    are returned here so only this process writes to the database. Only
+    max_pending transcripts are in flight at once to bound memory use.
+
+    """
+    pending = collections.deque()
+
+    with cf.ProcessPoolExecutor() as pool:
+        for transcript_id in transcript_ids:
+            compressed_xml = list(
+                db_conn.execute(
+                    "select compressed_xml from transcript where transcript_id = ?",
+                    [transcript_id],
+                )
+            )[0][0]
+            pending.append(
+                pool.submit(extract_transcript, transcript_id, compressed_xml)
             )
-        )
 
-    return debates, speeches
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+
+def get_members():
+    """Download the current member list from the parliamentary handbook."""
+    member_data = requests.get(
+        "https://handbookapi.aph.gov.au/api/"
+        "individuals?$orderby=FamilyName,GivenName&"
+        "$skip=0&$count=true&"
+        "$select=PHID,DisplayName,Gender,State,"
+        "Electorate,Party,DateOfBirth"
+    )
+    member_data.raise_for_status()
+
+    member_keys = "PHID,DisplayName,Gender,State,Electorate,Party,DateOfBirth".split(
+        ","
+    )
+
+    # Decoded straight from the bytes, which skips requests guessing the
+    # text encoding of the response.
+    return [
+        (member["PHID"].lower(), *(member[key] for key in member_keys[1:]))
+        for member in json.loads(member_data.content)["value"]
+    ]
 
 
 def tidy_hansard(
     db_path="hansard.db",
-    transcript_zip_path="hansard_transcripts.zip",
     rebuild=True,
 ):
-    if rebuild:
-        # Copy over the important bits to a new database, then replace the old
-        # database. This is faster than trying to empty out the database since
-        # we know we're going to throw everything out anyway.
-        temp_dir = tempfile.mkdtemp()
-        temp_path = os.path.join(temp_dir, "temp.db")
+    # Fetch the members in the background, overlapping the request with
+    # rebuilding and setting up the database.
+    member_pool = cf.ThreadPoolExecutor(max_workers=1)
+    member_rows = member_pool.submit(get_members)
+    member_pool.shutdown(wait=False)
+
+    if not rebuild:
+        db_conn = sqlite3.connect(db_path, isolation_level=None)
+
+        # Set up for the bulk load before anything is written. See the README
+        # for the durability tradeoff.
+        synchronous = os.environ.get("HANSARD_SQLITE_SYNCHRONOUS", "NORMAL").upper()
+        if synchronous not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+            raise ValueError(f"Unknown synchronous setting: {synchronous}")
+        db_conn.execute(f"pragma synchronous={synchronous}")
+        db_conn.execute("pragma journal_mode=WAL")
+
+        load_tidy_hansard(db_conn, member_rows)
+        db_conn.close()
+        return
+
+    # Copy over the important bits to a new database, load that, then replace
+    # the old database. This is faster than trying to empty out the database
+    # since we know we're going to throw everything out anyway. The copy is
+    # made next to the old database, so it's on a filesystem with room for it
+    # and can be moved into place without copying again.
+    temp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(db_path)))
+    temp_path = os.path.join(temp_dir, "temp.db")
+
+    try:
         temp_conn = sqlite3.connect(temp_path, isolation_level=None)
         temp_conn.execute("attach ? as old", [db_path])
 
@@ -189,11 +408,7 @@ def tidy_hansard(
             create table if not exists transcript (
                 /*
                 This table acts as the driver for what work needs to be done to keep
-                the collection fresh, and also acts as the index into the zipfile of
-                raw transcripts.
-
-                The transcript_id is also the path into the zipfile for this
-                transcript.
+                the collection fresh, and also stores the raw transcripts.
 
                 */
                 transcript_id primary key,
@@ -205,7 +420,9 @@ def tidy_hansard(
                 access_time,
                 -- The time the transcript was processed into the tidy schema.
                 -- Null indicates that the work is still outstanding.
-                process_time
+                process_time,
+                -- The downloaded XML transcript, compressed with zlib.
+                compressed_xml
             );
 
             insert into main.transcript select * from old.transcript;
@@ -220,16 +437,49 @@ def tidy_hansard(
             """
         )
         temp_conn.close()
-        os.rename(temp_path, db_path)
 
-    db_conn = sqlite3.connect(db_path, isolation_level=None)
+        db_conn = sqlite3.connect(temp_path, isolation_level=None)
+
+        # The old database is untouched until the rebuilt one replaces it, so
+        # a failed rebuild is recovered by running it again. There's nothing
+        # for a journal or fsyncs to protect during the bulk load.
+        db_conn.executescript(
+            """
+            pragma journal_mode=OFF;
+            pragma synchronous=OFF;
+            """
+        )
+
+        try:
+            load_tidy_hansard(db_conn, member_rows)
+        finally:
+            db_conn.close()
+
+        os.replace(temp_path, db_path)
+
+    finally:
+        # Only the partial database is left here if the rebuild failed.
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def load_tidy_hansard(db_conn, member_rows):
+    """Load the outstanding transcripts into the tidy schema in one transaction."""
+    db_conn.executescript(
+        """
+        pragma temp_store=MEMORY;
+        -- 256MiB page cache and 256MiB of memory mapped IO.
+        pragma cache_size=-262144;
+        pragma mmap_size=268435456;
+        pragma foreign_keys=0;
+        """
+    )
 
     # TODO: how do we handle changes in schema?
     # Drop and replace everything probably?
     # TODO: how do we handle incremental updates?
     # We probably don't want to reprocess everything for a single new transcript.
     # TODO: add indexes to support common queries and incremental updates.
-    schema_script = """
+    schema_tables = """
         create table if not exists member (
             -- Hansard data assigned
             phid primary key,
@@ -249,12 +499,9 @@ def tidy_hansard(
             house,
             debate,
             subdebate_1,
-            subdebate_2,
-            unique (date, house, debate, subdebate_1, subdebate_2)
+            subdebate_2
         );
 
-        create index if not exists transcript_debate on debate(transcript_id);
-
         create table if not exists speech (
             speech_id integer primary key,
             transcript_id references transcript on delete cascade,
@@ -263,28 +510,23 @@ def tidy_hansard(
             house,
             speech_number integer,
             speech_type text,
-            speech_xml,
-            unique(date, house, speech_number)
+            speech_xml
         );
 
-        create index if not exists transcript_speech on speech(transcript_id);
-        create index if not exists debate_speech on speech(debate_id);
-
+        -- The link tables are small rows identified by their primary key, so
+        -- they're stored in the primary key's B-tree rather than in a rowid
+        -- table plus a separate index.
         create table if not exists speech_speaker (
             speech_id integer references speech(speech_id) on delete cascade,
             phid references member(phid),
             primary key (speech_id, phid)
-        );
-        create index if not exists speaker_speech on speech_speaker(phid, speech_id);
+        ) without rowid;
 
         create table if not exists speech_interjector (
             speech_id integer references speech(speech_id) on delete cascade,
             phid references member(phid),
             primary key (speech_id, phid)
-        );
-        create index if not exists interjector_speech on speech_interjector(
-            phid, speech_id
-        );
+        ) without rowid;
 
         create table if not exists speech_turn (
             speech_id integer references speech on delete cascade,
@@ -297,39 +539,56 @@ def tidy_hansard(
         );
     """
 
-    db_conn.executescript(schema_script)
+    # The secondary indexes aren't needed while loading, so on a fresh
+    # database they're built in one pass after all of the rows are inserted.
+    # This includes the unique indexes: building them at the end checks the
+    # loaded data once, instead of on every insert.
+    schema_indexes = [
+        """
+        create unique index if not exists debate_unique on debate(
+            date, house, debate, subdebate_1, subdebate_2
+        )
+        """,
+        """
+        create unique index if not exists speech_unique on speech(
+            date, house, speech_number
+        )
+        """,
+        "create index if not exists transcript_debate on debate(transcript_id)",
+        "create index if not exists transcript_speech on speech(transcript_id)",
+        "create index if not exists debate_speech on speech(debate_id)",
+        "create index if not exists speaker_speech on speech_speaker(phid, speech_id)",
+        """
+        create index if not exists interjector_speech on speech_interjector(
+            phid, speech_id
+        )
+        """,
+    ]
+
+    db_conn.executescript(schema_tables)
+
+    # When updating existing data the indexes are needed to efficiently
+    # delete the data for outdated transcripts.
+    if list(db_conn.execute("select exists(select 1 from speech)"))[0][0]:
+        for statement in schema_indexes:
+            db_conn.execute(statement)
 
     db_conn.execute("begin")
 
     # Replace the members table
     db_conn.execute("delete from member")
-    member_data = requests.get(
-        "https://handbookapi.aph.gov.au/api/"
-        "individuals?$orderby=FamilyName,GivenName&"
-        "$skip=0&$count=true&"
-        "$select=PHID,DisplayName,Gender,State,"
-        "Electorate,Party,DateOfBirth"
+    db_conn.executemany(
+        "insert into member values(?, ?, ?, ?, ?, ?, ?)",
+        member_rows.result(),
     )
 
-    for member in member_data.json()["value"]:
-        values = [
-            member[key]
-            for key in "PHID,DisplayName,Gender,State,Electorate,Party,DateOfBirth".split(
-                ","
-            )
-        ]
-        values[0] = values[0].lower()
-        db_conn.execute("insert into member values(?, ?, ?, ?, ?, ?, ?)", values)
-
-    db_conn.execute("pragma foreign_keys=1")
-    # Delete outdated transcript rows by following the foreign key
-    # relationships
+    # Delete the previously extracted data for outdated transcripts. This is
+    # done explicitly, child tables first, rather than relying on foreign key
+    # cascades: pragma foreign_keys can't be changed inside the transaction.
     db_conn.execute(
         """
-        -- A replace is a delete followed by an insert - the delete
-        -- triggers the foreign key cascade.
-        replace into transcript
-        select *
+        create temporary table stale_transcript as
+        select transcript_id
         from transcript
         where xml_url is not null
             and access_time is not null
@@ -337,11 +596,28 @@ def tidy_hansard(
         """
     )
 
+    stale_speeches = """
+        select speech_id
+        from speech
+        where transcript_id in (select transcript_id from stale_transcript)
+    """
+
+    for table in ("speech_speaker", "speech_interjector", "speech_turn"):
+        db_conn.execute(f"delete from {table} where speech_id in ({stale_speeches})")
+
+    for table in ("speech", "debate"):
+        db_conn.execute(
+            f"""
+            delete from {table}
+            where transcript_id in (select transcript_id from stale_transcript)
+            """
+        )
+
     to_process = list(
         db_conn.execute(
             """
             select
-                transcript_id, last_mod
+                transcript_id
             from transcript
             where xml_url is not null
                 and access_time is not null
@@ -350,75 +626,112 @@ def tidy_hansard(
         )
     )
 
-    all_members = {row[0] for row in db_conn.execute("select phid from member")}
+    # The phids were lowercased when the members were loaded, matching the
+    # speaker and interjector ids extracted from the transcripts.
+    all_members = frozenset(
+        row[0] for row in db_conn.execute("select phid from member")
+    )
 
-    with zipfile.ZipFile(transcript_zip_path, "r") as transcripts:
-        for i, (transcript_id, last_mod) in enumerate(to_process):
-            # Skip the senate transcript duplicated into the HoR.
-            # TODO: double check if there's actually a HoR sitting for that day?
-            if transcript_id in skip_transcripts:
-                print(
-                    f"Skipping marked transcript - {transcript_id}. "
-                    f"Reason: {skip_transcripts[transcript_id]}"
-                )
-                continue
-            # print(transcript_id, f"{i + 1}/{len(to_process)}")
-            with transcripts.open(f"{transcript_id}/{last_mod}") as transcript_data:
-                transcript_xml = transcript_data.read()
+    debate_ids = {
+        tuple(row[1:]): row[0]
+        for row in db_conn.execute(
+            """
+            select debate_id, date, house, debate, subdebate_1, subdebate_2
+            from debate
+            """
+        )
+    }
+    next_debate_id = max(debate_ids.values(), default=0) + 1
+
+    next_speech_id = list(
+        db_conn.execute("select coalesce(max(speech_id), 0) + 1 from speech")
+    )[0][0]
+
+    transcript_ids = []
+
+    for (transcript_id,) in to_process:
+        # Skip the senate transcript duplicated into the HoR.
+        # TODO: double check if there's actually a HoR sitting for that day?
+        if transcript_id in skip_transcripts:
+            print(
+                f"Skipping marked transcript - {transcript_id}. "
+                f"Reason: {skip_transcripts[transcript_id]}"
+            )
+            continue
 
-            debates, speeches = extract_speeches(transcript_id, transcript_xml)
+        transcript_ids.append(transcript_id)
 
-            for debate in debates:
-                db_conn.execute(
-                    "insert into debate values(?, ?, ?, ?, ?, ?, ?)",
-                    debate,
-                )
+    processed_ids = []
 
-            for speech, speakers, interjectors in speeches:
-                db_conn.execute(
-                    """
-                    insert into speech values(
-                        ?1,
-                        ?2,
-                        (
-                            select
-                                debate_id
-                            from debate
-                            where (date, house, debate, subdebate_1, subdebate_2) =
-                                (?3, ?4, ?5, ?6, ?7)
-                        ),
-                        ?3,
-                        ?4,
-                        ?8,
-                        ?9,
-                        ?10
-                    )
-                    """,
-                    speech,
-                )
+    for transcript_id, debates, speeches in extract_transcripts(
+        db_conn, transcript_ids
+    ):
+        # Debates already seen are ignored, new debates are assigned the next
+        # id so speeches can refer to them without a lookup in SQLite.
+        debate_rows = []
 
-                speech_id = list(db_conn.execute("select last_insert_rowid()"))[0][0]
+        for debate in debates:
+            debate_key = debate[2:]
+            if debate_key not in debate_ids:
+                debate_ids[debate_key] = next_debate_id
+                debate_rows.append((next_debate_id, *debate[1:]))
+                next_debate_id += 1
 
-                # Insert only the valid keys
-                # TODO: figure out a strategy for handling the invalid member
-                # ids and the role based IDs.
-                db_conn.executemany(
-                    "insert into speech_speaker values(?, ?)",
-                    ((speech_id, phid) for phid in speakers & all_members),
-                )
-                db_conn.executemany(
-                    "insert into speech_interjector values(?, ?)",
-                    ((speech_id, phid) for phid in interjectors & all_members),
-                )
+        db_conn.executemany(
+            "insert into debate values(?, ?, ?, ?, ?, ?, ?)",
+            debate_rows,
+        )
+
+        # Speech ids are allocated here rather than by SQLite, so the speaker
+        # and interjector rows can be built without reading them back.
+        speech_rows = []
+        speaker_rows = []
+        interjector_rows = []
 
-            db_conn.execute(
-                "update transcript set process_time = ? where transcript_id = ?",
-                [datetime.now(), transcript_id],
+        for speech, speakers, interjectors in speeches:
+            speech_id = next_speech_id
+            next_speech_id += 1
+
+            date, house = speech[2:4]
+            debate_id = debate_ids[speech[2:7]]
+
+            speech_rows.append(
+                (speech_id, transcript_id, debate_id, date, house, *speech[7:])
+            )
+            speaker_rows.extend(
+                (speech_id, phid) for phid in speakers.intersection(all_members)
+            )
+            interjector_rows.extend(
+                (speech_id, phid) for phid in interjectors.intersection(all_members)
             )
 
+        db_conn.executemany(
+            "insert into speech values(?, ?, ?, ?, ?, ?, ?, ?)",
+            speech_rows,
+        )
+
+        # Insert only the valid keys
+        # TODO: figure out a strategy for handling the invalid member
+        # ids and the role based IDs.
+        db_conn.executemany("insert into speech_speaker values(?, ?)", speaker_rows)
+        db_conn.executemany(
+            "insert into speech_interjector values(?, ?)", interjector_rows
+        )
+
+        processed_ids.append(transcript_id)
+
+    # All transcripts in this run are marked processed together, in the same
+    # format the sqlite3 datetime adapter used.
+    process_time = datetime.now().isoformat(" ")
+    db_conn.executemany(
+        "update transcript set process_time = ? where transcript_id = ?",
+        ((process_time, transcript_id) for transcript_id in processed_ids),
+    )
+
+    for statement in schema_indexes:
+        db_conn.execute(statement)
+
     db_conn.execute("commit")
-    db_conn.execute("pragma journal_mode=WAL")
-    db_conn.close()
 
 
 if __name__ == "__main__":
@@ -10,15 +10,17 @@ Usage:
 python tidy_hansard.py
 
 """
+import collections
 import concurrent.futures as cf
 from datetime import datetime
+import functools
 from html import unescape
 import os
 import random
 import sqlite3
 import zlib
 
-from lxml import html
+from lxml import etree, html
 from tqdm import tqdm
 
 
@@ -62,30 +64,59 @@ schema_statements = [
     "pragma schema_version=1",
 ]
 
+# The page content and the definition list of metadata about it.
+content_panels = etree.XPath("//div[@id='documentContentPanel']")
+metadata_blocks = etree.XPath("//div[@class='metadata']")
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_date(date):
+    """Parse a metadata date - many pages from the same day share one."""
+    return datetime.strptime(date, "%d-%m-%Y").date()
+
+
+def parse_compressed_html(compressed_page, chunk_size=64 * 1024):
+    """
+    Parse a zlib compressed HTML page.
+
+    The page is decompressed a chunk at a time straight into the parser, so
+    the whole uncompressed page is never held in memory as bytes.
+
+    """
+    parser = html.HTMLParser()
+    decompressor = zlib.decompressobj()
+
+    for start in range(0, len(compressed_page), chunk_size):
+        parser.feed(
+            decompressor.decompress(compressed_page[start : start + chunk_size])
+        )
+
+    parser.feed(decompressor.flush())
+    return parser.close()
+
 
 def extract_page_data(url, access_time, compressed_page):
     """Extract just the metadata keys from the relevant page heading."""
 
     try:
-        html_page = zlib.decompress(compressed_page)
+        root = parse_compressed_html(compressed_page)
 
-        root = html.fromstring(html_page)
-        root.make_links_absolute("https://parlinfo.aph.gov.au")
-
-        content_comp = root.xpath("//div[@id='documentContentPanel']")
-        content = html.tostring(content_comp[0], with_tail=False, encoding="unicode")
-
-        metadata_block = root.xpath("//div[@class='metadata']")[0]
+        metadata_block = metadata_blocks(root)[0]
 
         # Extract the metadata tags from the relevant section by
-        # reassembling the definition list.
-        dts = metadata_block.xpath(".//dt")
-        dds = metadata_block.xpath(".//dd")
+        # reassembling the definition list, collecting both tags in a single
+        # walk of the block.
+        dts = []
+        dds = []
+        for elem in metadata_block.iter("dt", "dd"):
+            (dts if elem.tag == "dt" else dds).append(elem)
 
         key_values = (
             # Sometimes the empty values are filled with the HTML escape
             # &nbsp, sometimes they're filled with the '\xa0' character...
-            (key.text, unescape("".join(value.itertext())).strip())
+            # The escape survives parsing when the page double escapes it, so
+            # the unescape is still needed.
+            (key.text, unescape(value.text_content()).strip())
             for key, value in zip(dts, dds)
         )
 
@@ -93,16 +124,31 @@ def extract_page_data(url, access_time, compressed_page):
 
         # Title doesn't always exist, make sure it's there.
         metadata["Title"] = metadata.get("Title", "")
-        metadata["Date"] = datetime.strptime(metadata["Date"], "%d-%m-%Y").date()
+        metadata["Date"] = parse_date(metadata["Date"])
         metadata["Parl No."] = int(metadata["Parl No."])
 
+        # The content is only serialized once the metadata is known to be
+        # usable, so pages that fail don't pay for it. Only the stored content
+        # needs absolute links, so the rest of the page isn't rewritten.
+        content_comp = content_panels(root)
+        content_comp[0].make_links_absolute("https://parlinfo.aph.gov.au")
+        content = html.tostring(content_comp[0], with_tail=False, encoding="unicode")
+
     except Exception:
         return url, access_time, set(), None
 
     return url, access_time, metadata, content
 
 
-def insert_data(db_conn, result):
+def insert_data(db_conn, result, debate_ids, metadata_rows):
+    """
+    Insert the debate and page for an extracted result.
+
+    debate_ids maps the (date, house, title) of each debate inserted so far
+    to its debate_id. The metadata rows for the page are appended to
+    metadata_rows, to be inserted in batches across pages.
+
+    """
     url, access_time = result[:2]
     metadata, content = result[2:]
 
@@ -113,38 +159,23 @@ def insert_data(db_conn, result):
         )
 
     else:
-        # Make sure debate row exists
-        row_meta = [
-            metadata[key]
-            for key in [
-                "Date",
-                "Database",
-                "Parl No.",
-                "Title",
-            ]
-        ]
-        db_conn.execute(
-            "insert or ignore into main.debate values(?, ?, ?, ?, ?)",
-            (
-                None,
-                *row_meta,
-            ),
-        )
-
-        row_meta = [
-            metadata[key]
-            for key in [
-                "Date",
-                "Database",
-                "Title",
-            ]
-        ]
-        debate_id = list(
-            db_conn.execute(
-                "select debate_id from main.debate where (date, house, title) = (?, ?, ?)",
-                row_meta,
-            )
-        )[0][0]
+        # The target database starts empty, so every debate is in debate_ids
+        # once it has been inserted.
+        debate_key = (metadata["Date"], metadata["Database"], metadata["Title"])
+        debate_id = debate_ids.get(debate_key)
+
+        if debate_id is None:
+            debate_id = db_conn.execute(
+                "insert into main.debate values(?, ?, ?, ?, ?)",
+                (
+                    None,
+                    metadata["Date"],
+                    metadata["Database"],
+                    metadata["Parl No."],
+                    metadata["Title"],
+                ),
+            ).lastrowid
+            debate_ids[debate_key] = debate_id
 
         # Page content
         row_meta = [
@@ -155,20 +186,26 @@ def insert_data(db_conn, result):
                 "Parl No.",
             ]
         ]
-        db_conn.execute(
+        page_id = db_conn.execute(
             "insert into main.proceedings_page values (?, ?, ?, ?, ?, ?, ?, ?)",
             (None, url, access_time, *row_meta, debate_id, content),
-        )
-        page_id = list(db_conn.execute("select last_insert_rowid()"))[0][0]
+        ).lastrowid
 
         # All metadata for reference.
-        db_conn.executemany(
-            "insert into main.metadata values (?, ?, ?)",
-            ((page_id, key, value) for key, value in metadata.items()),
-        )
+        metadata_rows.extend((page_id, key, value) for key, value in metadata.items())
+
 
+def flush_metadata(db_conn, metadata_rows):
+    db_conn.executemany("insert into main.metadata values (?, ?, ?)", metadata_rows)
+    metadata_rows.clear()
 
-def tidy_hansard(source_db="hansard_html.db", target_db="tidy_hansard.db"):
+
+def tidy_hansard(
+    source_db="hansard_html.db",
+    target_db="tidy_hansard.db",
+    max_pending=64,
+    metadata_batch_size=5000,
+):
     """ """
 
     if os.path.exists(target_db):
@@ -197,12 +234,18 @@ def tidy_hansard(source_db="hansard_html.db", target_db="tidy_hansard.db"):
         )
     )[0][0]
 
-    futures = set()
     pbar = tqdm(
         total=to_process,
         smoothing=0.01,
     )
 
+    # Pages are submitted in order, and results are inserted in the same
+    # order, with only a bounded number in flight so the compressed pages
+    # waiting on a worker don't pile up in memory.
+    pending = collections.deque()
+    debate_ids = {}
+    metadata_rows = []
+
     with cf.ProcessPoolExecutor() as pool:
         for row in db_conn.execute(
             """
@@ -212,20 +255,23 @@ def tidy_hansard(source_db="hansard_html.db", target_db="tidy_hansard.db"):
             where access_time is not null
             """,
         ):
-            futures.add(pool.submit(extract_page_data, *row))
+            pending.append(pool.submit(extract_page_data, *row))
 
-            if len(futures) >= 1000:
-                done, futures = cf.wait(futures, return_when="FIRST_COMPLETED")
+            if len(pending) >= max_pending:
+                insert_data(
+                    db_conn, pending.popleft().result(), debate_ids, metadata_rows
+                )
+                pbar.update(1)
 
-                for future in done:
-                    insert_data(db_conn, future.result())
+                if len(metadata_rows) >= metadata_batch_size:
+                    flush_metadata(db_conn, metadata_rows)
 
-                pbar.update(len(done))
+        while pending:
+            insert_data(db_conn, pending.popleft().result(), debate_ids, metadata_rows)
+            pbar.update(1)
 
-        for future in cf.as_completed(futures):
-            insert_data(db_conn, future.result())
+        flush_metadata(db_conn, metadata_rows)
 
-        pbar.update(len(futures))
         pbar.close()
 
     db_conn.execute("commit")